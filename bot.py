@@ -2,13 +2,23 @@
 """Bot for various administrative duties in The Solas Council."""
 
 import asyncio
+import bisect
+import csv
+import gzip
+import io
+import json
 import logging
 import math
 import os
+import re
+import signal
+import socket
 import sqlite3
 import sys
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Optional
+from time import monotonic
+from typing import AsyncIterator, Iterator, Optional
 
 import discord
 from discord import app_commands, Client, Guild, Intents, Interaction, Member, User
@@ -21,6 +31,15 @@ sys.stdout.reconfigure(line_buffering=True)
 # Config
 
 DRY_RUN = os.environ.get('DRY_RUN', 'False').lower() == 'true'
+# Run as one of several processes sharing the database, only the lease holder connects to Discord
+FAILOVER = os.environ.get('FAILOVER', 'False').lower() == 'true'
+# Hold the lease without connecting to Discord, for testing handovers locally
+FAKE_GATEWAY = os.environ.get('FAKE_GATEWAY', 'False').lower() == 'true'
+LEASE_SECONDS = float(os.environ.get('LEASE_SECONDS', '15'))
+# How often a standby checks whether the lease was released
+LEASE_POLL_SECONDS = 0.5
+DATABASE = os.environ.get('DATABASE', 'users.db')
+INSTANCE_ID = f'{socket.gethostname()}:{os.getpid()}'
 
 # Discord Stuff
 
@@ -44,8 +63,12 @@ COLORS = {
 }
 
 # Connect to local database
-CONN = sqlite3.connect('users.db')
+# With failover, give up on a locked database quickly rather than stall the event loop
+CONN = sqlite3.connect(DATABASE, timeout=(1 if FAILOVER else 5))
 CURSOR = CONN.cursor()
+if FAILOVER:
+    # Readers and the writer no longer block each other
+    CURSOR.execute('PRAGMA journal_mode=WAL;')
 # Create tables if they don't exist
 CURSOR.execute('''
     CREATE TABLE IF NOT EXISTS bans (
@@ -59,6 +82,22 @@ CURSOR.execute('''
         date TIMESTAMP
     );
 ''')
+CURSOR.execute('''
+    CREATE TABLE IF NOT EXISTS lease (
+        id INT NOT NULL PRIMARY KEY CHECK (id = 0),
+        holder TEXT NOT NULL,
+        expires REAL NOT NULL
+    );
+''')
+CURSOR.execute('''
+    CREATE TABLE IF NOT EXISTS synced (
+        id INT NOT NULL PRIMARY KEY CHECK (id = 0),
+        version TEXT NOT NULL
+    );
+''')
+# Indexes for paging through filtered /modlog exports
+CURSOR.execute('CREATE INDEX IF NOT EXISTS bans_date_user ON bans (date, user);')
+CURSOR.execute('CREATE INDEX IF NOT EXISTS timeouts_date_user ON timeouts (date, user);')
 
 # Helper functions
 
@@ -121,6 +160,48 @@ def remove_from_ban_db(user: User):
     )
     CONN.commit()
 
+async def ban_user(user: Member | User, type: str, reason: str) -> bool:
+    """Record a ban of the given type in the database, then ban the user.
+
+    Returns False if no ban was issued (dry run). Discord errors are left to the caller.
+    """
+    # Add to database
+    if type == 'ban':
+        CURSOR.execute(
+            '''
+                INSERT INTO bans
+                VALUES (?, date('now'))
+                ON CONFLICT (user) DO
+                    UPDATE SET date = date('now');
+            ''',
+            (user.id,))
+        CONN.commit()
+    # Remove from database if permanent ban and already there
+    else:
+        remove_from_ban_db(user)
+
+    # Ban user
+    if DRY_RUN:
+        return False
+    await client.primary_guild.ban(
+        user,
+        reason=reason,
+        delete_message_seconds=(604800 if type == 'spam' else 0))
+    return True
+
+def record_timeout(user: Member | User, length: timedelta):
+    """Add or extend a user's timeout in the SQLite database."""
+    sqlite_time_string = f'+{length.total_seconds()} seconds'
+    CURSOR.execute(
+        '''
+            INSERT INTO timeouts
+            VALUES (?, datetime('now', ?))
+            ON CONFLICT (user) DO
+                UPDATE SET date = datetime('now', ?);
+        ''',
+        (user.id, sqlite_time_string, sqlite_time_string))
+    CONN.commit()
+
 async def log_action(action: str, user: Member, info: Optional[str]='', color: Optional[int]=COLORS['event']):
     """Log a bot action, with optional additional information."""
     embed = discord.Embed(
@@ -133,6 +214,275 @@ async def log_action(action: str, user: Member, info: Optional[str]='', color: O
 
     await client.logging_channels['mod_actions'].send(user.mention, embed=embed)
 
+# Spam filter
+
+SPAM_FILTER = {
+    'bucket_capacity': 20,  # tokens a user may spend in a burst
+    'bucket_refill': 1.0,  # tokens regained per second
+    'link_cost': 5,  # tokens spent on a message with a link (other messages cost 1)
+    'repeat_channels': 3,  # distinct channels the same link message may reach before a timeout
+    'repeat_window': 120,  # seconds a link message is remembered for cross-channel matching
+    'max_tracked': 50000,  # upper bound on remembered users and messages
+    'log_interval': 30,  # seconds between batched spam filter log items
+    'rate_timeout': timedelta(minutes=10),  # timeout for flooding without posting scams
+}
+
+# Known scam domains (subdomains match too)
+SPAM_DOMAINS = frozenset({
+    'discord-nitro.gift',
+    'discordnitro.gift',
+    'discord-gift.com',
+    'discordgift.site',
+    'dlscord.gift',
+    'dlscord.com',
+    'steamcommunlty.com',
+    'steamcomminuty.com',
+    'stearncommunity.com',
+})
+# Misspellings of Discord/Steam in a domain (the correct spelling is not matched)
+SPAM_LOOKALIKE = re.compile(r'd[il1]s[ck]{1,2}[o0]rd|st[e3][a4]?(?:m|rn)[ck]?[o0]m+[ui]n[il1]t[yi]')
+SPAM_LOOKALIKE_GENUINE = ('discord', 'steamcommunity')
+LINK_PATTERN = re.compile(r'https?://(?:[^\s/@]+@)?([^\s/:?#<>]{1,253})', re.IGNORECASE)
+# Whitespace and zero-width characters, collapsed when comparing message content
+NORMALIZE_PATTERN = re.compile(r'[\s\u200b-\u200f\u2060\ufeff]+')
+
+class SpamFilter:
+    """Flag spam using a token bucket per user and a rolling window of link message hashes.
+
+    Every check does a constant amount of dictionary work, and all state is capped at
+    `max_tracked` entries, evicting the oldest first.
+    """
+
+    def __init__(self, settings: dict):
+        self.settings = settings
+        self.buckets = OrderedDict()  # user id -> (tokens, last update)
+        self.recent = OrderedDict()  # (user id, content hash) -> (first seen, channel ids)
+        self.flagged = OrderedDict()  # user ids already handed to the spam-ban path
+
+    def _trim(self, table: OrderedDict):
+        """Evict the oldest entries of a table until it fits within max_tracked."""
+        while len(table) > self.settings['max_tracked']:
+            table.popitem(last=False)
+
+    @staticmethod
+    def _is_blocked_domain(domain: str) -> bool:
+        """Check a domain (and each parent domain) against the scam lists."""
+        labels = domain.split('.')
+        if any('.'.join(labels[i:]) in SPAM_DOMAINS for i in range(len(labels) - 1)):
+            return True
+        return any(
+            match.group(0) not in SPAM_LOOKALIKE_GENUINE
+            for match in SPAM_LOOKALIKE.finditer(domain))
+
+    def check(
+        self,
+        message: discord.Message,
+        now: Optional[float]=None
+    ) -> Optional[tuple[str, str]]:
+        """Return the action to take ('spam' ban or 'timeout') and why, or None if it looks fine.
+
+        Only scam links call for a spam ban. Flooding, or cross-posting the same link message,
+        without one calls for a timeout.
+        """
+        author_id = message.author.id
+        if author_id in self.flagged:
+            return None
+        now = monotonic() if now is None else now
+
+        domains = [
+            match.group(1).lower().rstrip('.')
+            for match in LINK_PATTERN.finditer(message.content)]
+
+        reason = None
+        blocked = [domain for domain in domains if self._is_blocked_domain(domain)]
+        if blocked:
+            reason = f'posted a link to a known scam domain (`{blocked[0]}`)'
+
+        # Token bucket, links cost extra
+        capacity = self.settings['bucket_capacity']
+        tokens, last = self.buckets.pop(author_id, (capacity, now))
+        tokens = min(capacity, tokens + (now - last) * self.settings['bucket_refill'])
+        tokens -= self.settings['link_cost'] if domains else 1
+        self.buckets[author_id] = (tokens, now)
+        self._trim(self.buckets)
+        flooding = None
+        if tokens < 0:
+            flooding = 'sent messages faster than the rate limit'
+
+        # Same link message in several channels
+        if domains:
+            normalized = NORMALIZE_PATTERN.sub(' ', message.content.lower()).strip()
+            key = (author_id, hash(normalized))
+            window = self.settings['repeat_window']
+            first_seen, channels = self.recent.pop(key, (now, set()))
+            if now - first_seen > window:
+                first_seen, channels = now, set()
+            channels.add(message.channel.id)
+            self.recent[key] = (first_seen, channels)
+            # Least recently seen entries collect at the front, drop them once expired
+            while self.recent and now - next(iter(self.recent.values()))[0] > window:
+                self.recent.popitem(last=False)
+            self._trim(self.recent)
+            if flooding is None and len(channels) >= self.settings['repeat_channels']:
+                flooding = f'posted the same link message in {len(channels)} channels'
+                # Forget it, so copies already in flight don't time out again
+                del self.recent[key]
+
+        if reason is not None:
+            self.flagged[author_id] = now
+            self._trim(self.flagged)
+            del self.buckets[author_id]
+            return 'spam', reason
+        if flooding is not None:
+            # Start over with a full bucket, so messages already in flight don't time out again
+            del self.buckets[author_id]
+            return 'timeout', flooding
+        return None
+
+SPAM = SpamFilter(SPAM_FILTER)
+# Lines waiting to be sent in the next batched spam filter log item
+SPAM_LOG = []
+
+def is_exempt(member: Member) -> bool:
+    """Check if a member is staff, or above the bot's jurisdiction."""
+    role_ids = [role.id for role in member.roles]
+    if PRIMARY_GUILD['staff_role_id'] in role_ids:
+        return True
+    guild_roles = [role.id for role in client.primary_guild.roles]
+    try:
+        return guild_roles.index(member.roles[-1].id) > guild_roles.index(PRIMARY_GUILD['max_bannable_role_id'])  # pylint: disable=line-too-long
+    except ValueError:
+        return True
+
+async def flush_spam_log():
+    """Periodically send the spam filter's bans as a single log item."""
+    while True:
+        await asyncio.sleep(SPAM_FILTER['log_interval'])
+        if not SPAM_LOG:
+            continue
+        lines = SPAM_LOG.copy()
+        SPAM_LOG.clear()
+
+        # Discord embed descriptions must be ≤ 4096 characters
+        chunks = ['']
+        for line in lines:
+            if len(chunks[-1]) + len(line) + 1 > 4096:
+                chunks.append('')
+            chunks[-1] += f'{line}\n'
+        for chunk in chunks:
+            try:
+                await log_action('spam filter', client.user, info=chunk, color=COLORS['ban'])
+            except discord.errors.HTTPException as _e:
+                logging.error('Unable to send spam filter log:\n%s', _e)
+
+# Ban index
+
+class BanIndex:
+    """Prefix index over banned users' names and IDs, for /unban autocomplete.
+
+    Keys live in a sorted array, so a search is a bisection followed by a short scan.
+    """
+
+    def __init__(self):
+        self.keys = []  # sorted (lowercase name or ID, user id)
+        self.users = {}  # user id -> (User if known, keys)
+        # During a rebuild: user id -> User (or None) if banned, or False if unbanned
+        self.pending = None
+
+    @staticmethod
+    def _keys_for(user_id: int, user: Optional[User]) -> tuple[str, ...]:
+        """List every string a user can be found by."""
+        keys = {str(user_id)}
+        if user:
+            keys.update(name.lower() for name in (user.name, user.global_name) if name)
+        return tuple(keys)
+
+    def begin_rebuild(self) -> bool:
+        """Start recording changes to replay over a snapshot, unless already rebuilding."""
+        if self.pending is not None:
+            return False
+        self.pending = {}
+        return True
+
+    def build(self, entries: dict[int, Optional[User]]):
+        """Replace the whole index, sorting once rather than inserting one at a time.
+
+        Bans and unbans seen since begin_rebuild() are applied over the snapshot.
+        """
+        for user_id, user in (self.pending or {}).items():
+            if user is False:
+                entries.pop(user_id, None)
+            elif user is not None or user_id not in entries:
+                entries[user_id] = user
+        self.pending = None
+        self.users = {
+            user_id: (user, self._keys_for(user_id, user))
+            for user_id, user in entries.items()}
+        self.keys = sorted(
+            (key, user_id)
+            for user_id, (_, keys) in self.users.items()
+            for key in keys)
+
+    def add(self, user_id: int, user: Optional[User]=None):
+        """Add or update a single banned user."""
+        if self.pending is not None and (user is not None or not self.pending.get(user_id)):
+            self.pending[user_id] = user
+        if user_id in self.users:
+            if user is None:
+                return
+            self.remove(user_id)
+        keys = self._keys_for(user_id, user)
+        for key in keys:
+            bisect.insort(self.keys, (key, user_id))
+        self.users[user_id] = (user, keys)
+
+    def remove(self, user_id: int):
+        """Remove a single user, if they are in the index."""
+        if self.pending is not None:
+            self.pending[user_id] = False
+        _, keys = self.users.pop(user_id, (None, ()))
+        for key in keys:
+            i = bisect.bisect_left(self.keys, (key, user_id))
+            if i < len(self.keys) and self.keys[i] == (key, user_id):
+                del self.keys[i]
+
+    def get(self, user_id: int) -> Optional[User]:
+        """Return the cached User for an ID, if known."""
+        return self.users.get(user_id, (None,))[0]
+
+    def search(self, prefix: str, limit: int=25) -> list[int]:
+        """Return up to limit user IDs with a name or ID starting with prefix."""
+        prefix = prefix.strip().lower()
+        results = []
+        i = bisect.bisect_left(self.keys, (prefix,))
+        while i < len(self.keys) and len(results) < limit:
+            key, user_id = self.keys[i]
+            if not key.startswith(prefix):
+                break
+            if user_id not in results:
+                results.append(user_id)
+            i += 1
+        return results
+
+BANS = BanIndex()
+
+async def refresh_ban_index():
+    """Rebuild the ban index from the database and a snapshot of the guild's bans."""
+    if not BANS.begin_rebuild():
+        return
+    entries = {user_id: None for user_id, in CONN.execute('SELECT user FROM bans;')}
+    try:
+        async for entry in client.primary_guild.bans(limit=None):
+            entries[entry.user.id] = entry.user
+    except discord.errors.Forbidden:
+        logging.error(
+            'Lacking permissions to list bans, /unban suggestions only include 3-month bans.')
+    except Exception:
+        BANS.pending = None
+        raise
+    BANS.build(entries)
+    logging.info('Indexed %s banned users.', len(entries))
+
 # Bot commands
 
 @tree.command(name='ban', description='3 month ban')
@@ -169,29 +519,10 @@ async def ban(interaction: Interaction, user: User, type: str, reason: Optional[
     if dm_message != '' and not await send_dm(user, dm_message):
         got_dm = False
 
-    # Add to database
-    if type == 'ban':
-        CURSOR.execute(
-            '''
-                INSERT INTO bans
-                VALUES (?, date('now'))
-                ON CONFLICT (user) DO
-                    UPDATE SET date = date('now');
-            ''',
-            (user.id,))
-        CONN.commit()
-    # Remove from database if permanent ban and already there
-    else:
-        remove_from_ban_db(user)
-
-    # Ban user
-    if DRY_RUN:
-        return
+    # Add to database and ban user
     try:
-        await client.primary_guild.ban(
-            user,
-            reason=reason,
-            delete_message_seconds=(604800 if type == 'spam' else 0))
+        if not await ban_user(user, type, reason):
+            return
     except discord.errors.Forbidden:
         return await interaction.followup.send(f'I lack permissions to ban {user}!')
     except Exception as _e:
@@ -292,16 +623,7 @@ async def timeout(
         got_dm = False
 
     # Add to database
-    sqlite_time_string = f'+{SOLAS_TIMEOUTS[time].total_seconds()} seconds'
-    CURSOR.execute(
-        '''
-            INSERT INTO timeouts
-            VALUES (?, datetime('now', ?))
-            ON CONFLICT (user) DO
-                UPDATE SET date = datetime('now', ?);
-        ''',
-        (user.id, sqlite_time_string, sqlite_time_string))
-    CONN.commit()
+    record_timeout(user, SOLAS_TIMEOUTS[time])
 
     # Timeout user
     is_member = False
@@ -364,14 +686,36 @@ async def clear(interaction: Interaction):
 
 @tree.command(name='unban', description="Manually lift a user's ban.")
 @app_commands.describe(
-    user='Member to unban.',
+    user='Banned user to unban (search by name or ID).',
     reason='Optional reason for unban (not sent to user).'
 )
-async def unban(interaction: Interaction, user: User, reason: Optional[str]):
+async def unban(interaction: Interaction, user: str, reason: Optional[str]):
     """Unban a user."""
-    if await try_authorization(interaction, user) is False:
+    # Banned users aren't members, so only the staff check applies
+    if await try_authorization(interaction) is False:
         return
 
+    # Resolve the ID, preferring the User cached in the ban index over a REST lookup
+    try:
+        user_id = int(user)
+    except ValueError:
+        return await interaction.response.send_message(
+            f'`{user}` is not a user ID, please pick one of the suggestions.',
+            ephemeral=True)
+    user = BANS.get(user_id)
+    if user is None:
+        try:
+            user = await client.fetch_user(user_id)
+        except discord.errors.NotFound:
+            return await interaction.response.send_message(
+                f'No user with ID `{user_id}` exists.',
+                ephemeral=True)
+        except discord.errors.HTTPException as _e:
+            logging.error('EXCEPTION IN /unban:\n%s', _e)
+            return await interaction.response.send_message(
+                f'Unable to look up user `{user_id}`, please try again.',
+                ephemeral=True)
+
     remove_from_ban_db(user)
 
     # Unban user
@@ -392,6 +736,209 @@ async def unban(interaction: Interaction, user: User, reason: Optional[str]):
     return await interaction.response.send_message(
         f'Unbanned {user_info} with reason `{reason}`.')
 
+@unban.autocomplete('user')
+async def unban_autocomplete(
+    interaction: Interaction,
+    current: str
+) -> list[app_commands.Choice[str]]:
+    """Suggest banned users whose name or ID starts with what has been typed so far."""
+    # Only staff may see who is banned, check cached roles to stay within the deadline
+    if not isinstance(interaction.user, Member) or not PRIMARY_GUILD['staff_role_id'] in [role.id for role in interaction.user.roles]:  # pylint: disable=line-too-long
+        return []
+
+    choices = []
+    for user_id in BANS.search(current):
+        user = BANS.get(user_id)
+        name = f'{user.name} ({user_id})' if user else str(user_id)
+        choices.append(app_commands.Choice(name=name[:100], value=str(user_id)))
+    return choices
+
+modlog = app_commands.Group(name='modlog', description='Moderation records.')
+tree.add_command(modlog)
+
+# Record type -> (table, what the table's date means)
+MODLOG_TABLES = {
+    'ban': ('bans', 'issued'),  # when the 3-month ban was issued
+    'timeout': ('timeouts', 'ends'),  # when the timeout ends
+}
+MODLOG_FIELDS = ('type', 'user', 'issued', 'ends')
+# (type, user, issued, ends), only one of the dates is known for each type
+ModlogRecord = tuple[str, int, Optional[str], Optional[str]]
+# Rows read per query, no statement stays open between pages
+MODLOG_PAGE_SIZE = 1000
+# Room left for compressed data zlib hasn't flushed yet when splitting attachments
+MODLOG_SPLIT_MARGIN = 256 * 1024
+
+def modlog_pages(
+    user_id: Optional[int]=None,
+    since: Optional[str]=None,
+    until: Optional[str]=None
+) -> Iterator[list[ModlogRecord]]:
+    """Yield pages of records from the moderation tables, filtering on each table's date.
+
+    Pages are read by keyset on (date, user), each with its own complete query, so no read
+    lock is held while the caller uploads.
+    """
+    clauses = []
+    params = []
+    if user_id is not None:
+        clauses.append('user = ?')
+        params.append(user_id)
+    if since is not None:
+        clauses.append('date >= ?')
+        params.append(since)
+    if until is not None:
+        clauses.append("date < date(?, '+1 day')")
+        params.append(until)
+
+    for record_type, (table, field) in MODLOG_TABLES.items():
+        after = []
+        while True:
+            page_clauses = clauses + (['(date, user) > (?, ?)'] if after else [])
+            where = f'WHERE {" AND ".join(page_clauses)}' if page_clauses else ''
+            rows = CONN.execute(
+                f'SELECT user, date FROM {table} {where} ORDER BY date, user LIMIT ?;',
+                params + after + [MODLOG_PAGE_SIZE]).fetchall()
+            if rows:
+                if field == 'issued':
+                    yield [(record_type, user, date, None) for user, date in rows]
+                else:
+                    yield [(record_type, user, None, date) for user, date in rows]
+            if len(rows) < MODLOG_PAGE_SIZE:
+                break
+            after = [rows[-1][1], rows[-1][0]]
+
+class ModlogWriter:
+    """Encode records as gzip-compressed CSV or NDJSON.
+
+    A new file is started whenever the current one nears limit.
+    """
+
+    def __init__(self, fmt: str, limit: int):
+        self.fmt = fmt
+        self.limit = limit
+        self.line = io.StringIO()
+        self.writer = csv.writer(self.line, lineterminator='\n')
+        self.header = self._encode(MODLOG_FIELDS) if fmt == 'csv' else b''
+        self.buffer = None
+        self.archive = None
+
+    def _encode(self, row) -> bytes:
+        """Encode a single record as one line."""
+        if self.fmt == 'ndjson':
+            record_type, user, issued, ends = row
+            record = {'type': record_type, 'user': str(user), 'issued': issued, 'ends': ends}
+            return (json.dumps(record) + '\n').encode()
+        self.line.seek(0)
+        self.line.truncate()
+        self.writer.writerow(row)
+        return self.line.getvalue().encode()
+
+    def _start(self):
+        """Begin a new file."""
+        self.buffer = io.BytesIO()
+        self.archive = gzip.GzipFile(fileobj=self.buffer, mode='wb')
+        self.archive.write(self.header)
+
+    def _finish(self) -> io.BytesIO:
+        """Complete the current file, and return it ready for reading."""
+        self.archive.close()
+        self.archive = None
+        self.buffer.seek(0)
+        return self.buffer
+
+    def write(self, rows: list[ModlogRecord]) -> list[io.BytesIO]:
+        """Add records, returning any files that filled up."""
+        done = []
+        room = self.limit - MODLOG_SPLIT_MARGIN
+        for row in rows:
+            data = self._encode(row)
+            if self.archive is not None and self.buffer.tell() + len(data) > room:
+                done.append(self._finish())
+            if self.archive is None:
+                self._start()
+            self.archive.write(data)
+        return done
+
+    def close(self) -> io.BytesIO:
+        """Return the last file (an empty one if nothing matched)."""
+        if self.archive is None:
+            self._start()
+        return self._finish()
+
+async def modlog_parts(
+    pages: Iterator[list[ModlogRecord]],
+    fmt: str,
+    limit: int
+) -> AsyncIterator[io.BytesIO]:
+    """Compress pages of records off the event loop, yielding files as they fill up."""
+    writer = ModlogWriter(fmt, limit)
+    for page in pages:
+        for buffer in await asyncio.to_thread(writer.write, page):
+            yield buffer
+    yield await asyncio.to_thread(writer.close)
+
+@modlog.command(name='export', description='Export ban and timeout records as compressed files.')
+@app_commands.describe(
+    format='File format of the export.',
+    user='Only include records for this user.',
+    since='Only include bans issued, or timeouts ending, on or after this day (YYYY-MM-DD).',
+    until='Only include bans issued, or timeouts ending, on or before this day (YYYY-MM-DD).'
+)
+@app_commands.choices(format=[
+    app_commands.Choice(name='CSV', value='csv'),
+    app_commands.Choice(name='NDJSON (one JSON object per line)', value='ndjson')
+])
+async def modlog_export(
+    interaction: Interaction,
+    format: str,
+    user: Optional[User]=None,
+    since: Optional[str]=None,
+    until: Optional[str]=None
+):
+    """Send moderation records as gzip attachments, split to fit the upload limit."""
+    if await try_authorization(interaction) is False:
+        return
+
+    for value in (since, until):
+        if value is None:
+            continue
+        try:
+            datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            return await interaction.response.send_message(
+                f'`{value}` is not a date, please use YYYY-MM-DD.',
+                ephemeral=True)
+
+    await interaction.response.defer(ephemeral=True)
+
+    # Discord's upload limit without boosts is 10 MiB
+    limit = interaction.guild.filesize_limit if interaction.guild else 10 * 1024 * 1024
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    pages = modlog_pages(user.id if user else None, since, until)
+    part = 0
+    async for buffer in modlog_parts(pages, format, limit):
+        part += 1
+        try:
+            await interaction.followup.send(
+                file=discord.File(buffer, filename=f'modlog-{stamp}-{part}.{format}.gz'),
+                ephemeral=True)
+        except discord.errors.HTTPException as _e:
+            logging.error('EXCEPTION IN /modlog export:\n%s', _e)
+            return await interaction.followup.send(
+                'Unable to upload export, check logs.',
+                ephemeral=True)
+
+    filters = (
+        ('user', user and f'{user.mention} (`{user.id}`)'),
+        ('since', since),
+        ('until', until))
+    filters = ', '.join(f'{name}: {value}' for name, value in filters if value) or 'none'
+    await log_action(
+        'modlog export',
+        interaction.user,
+        info=f'format: {format}\nfilters: {filters}\nfiles: {part}')
+
 # Non commands
 
 async def restore_users():
@@ -434,6 +981,99 @@ async def restore_users():
             DELETE FROM timeouts
             WHERE date < datetime('now');
         ''')
+        CONN.commit()
+
+# Failover
+
+def try_lease() -> bool:
+    """Take the leader lease if it is free or expired, or renew it if we already hold it."""
+    now = datetime.now().timestamp()
+    try:
+        CURSOR.execute(
+            '''
+                INSERT INTO lease
+                VALUES (0, ?, ?)
+                ON CONFLICT (id) DO
+                    UPDATE SET holder = excluded.holder, expires = excluded.expires
+                    WHERE holder = excluded.holder OR expires < ?;
+            ''',
+            (INSTANCE_ID, now + LEASE_SECONDS, now))
+        CONN.commit()
+    except sqlite3.OperationalError as _e:
+        # Most likely the other process is writing, try again next time
+        logging.warning('Unable to update lease: %s', _e)
+        # Don't keep the write lock of a failed transaction
+        CONN.rollback()
+        return False
+    return CURSOR.rowcount == 1
+
+def release_lease():
+    """Expire our lease immediately, so a standby can take over without waiting."""
+    try:
+        CURSOR.execute(
+            '''
+                UPDATE lease
+                SET expires = 0
+                WHERE holder = ?;
+            ''',
+            (INSTANCE_ID,))
+        CONN.commit()
+    except sqlite3.OperationalError as _e:
+        logging.warning('Unable to release lease, standby will wait for it to expire: %s', _e)
+        CONN.rollback()
+
+async def sync_commands():
+    """Sync the command tree, unless this version already did (e.g. before a failover takeover)."""
+    # Images built without a VERSION build argument have it set, but empty
+    version = os.environ.get('VERSION') or None
+    CURSOR.execute('SELECT version FROM synced;')
+    synced = CURSOR.fetchone()
+    if version is not None and synced is not None and synced[0] == version:
+        logging.info('Commands already synced for %s.', version)
+        return
+
+    await tree.sync()
+    if version is None:
+        return
+    try:
+        CURSOR.execute(
+            '''
+                INSERT INTO synced
+                VALUES (0, ?)
+                ON CONFLICT (id) DO
+                    UPDATE SET version = excluded.version;
+            ''',
+            (version,))
+        CONN.commit()
+    except sqlite3.OperationalError as _e:
+        logging.warning('Unable to record command sync: %s', _e)
+        CONN.rollback()
+
+async def wait_for_lease():
+    """Stay on standby until the leader lease can be taken."""
+    logging.info('Standing by as %s...', INSTANCE_ID)
+    while True:
+        # Reading is cheap and doesn't block the leader, only try to write once the lease is free
+        try:
+            lease = CONN.execute('SELECT expires FROM lease;').fetchone()
+        except sqlite3.OperationalError:
+            lease = None
+        if (lease is None or lease[0] < datetime.now().timestamp()) and try_lease():
+            break
+        await asyncio.sleep(LEASE_POLL_SECONDS)
+    logging.info('Acquired leader lease as %s.', INSTANCE_ID)
+
+async def hold_lease():
+    """Renew the leader lease, and shut down well before a standby could take it."""
+    renewed = datetime.now().timestamp()
+    while True:
+        await asyncio.sleep(LEASE_SECONDS / 6)
+        attempt = datetime.now().timestamp()
+        if try_lease():
+            renewed = attempt
+        elif datetime.now().timestamp() - renewed >= LEASE_SECONDS * 2 / 3:
+            logging.error('Unable to renew leader lease, shutting down.')
+            return
 
 # Events
 
@@ -449,12 +1089,19 @@ async def on_ready():
     except discord.errors.NotFound as _e:
         logging.error('Unable to fetch guild or channel!\n%s', _e)
         raise
-    client.loop.create_task(restore_users())
+    # on_ready runs again after reconnecting, only start these once
+    if getattr(client, 'restore_task', None) is None:
+        client.restore_task = client.loop.create_task(restore_users())
+    if getattr(client, 'spam_log_task', None) is None:
+        client.spam_log_task = client.loop.create_task(flush_spam_log())
+    client.loop.create_task(refresh_ban_index())
     await asyncio.sleep(5)
     await client.change_presence(activity=discord.Activity(
         type=discord.ActivityType.watching,
         name=f"{SERVER_NAME} ({os.environ.get('VERSION', 'unspecified bot version')})"))
-    await tree.sync()
+    if not getattr(client, 'synced', False):
+        await sync_commands()
+        client.synced = True
 
 @client.event
 async def on_member_join(member: Member):
@@ -538,6 +1185,50 @@ async def on_member_remove(member: Member):
     await client.logging_channels['member_leave'].send(embed=embed)
 
 
+@client.event
+async def on_message(message: discord.Message):
+    """Ban accounts flooding the primary guild with spam/scam links, and timeout other floods."""
+    if (
+        message.guild is None or
+        message.guild.id != client.primary_guild.id or
+        message.author.bot or
+        not isinstance(message.author, Member)
+    ):
+        return
+
+    result = SPAM.check(message)
+    if result is None:
+        return
+    action, reason = result
+    if is_exempt(message.author):
+        SPAM.flagged.pop(message.author.id, None)
+        return
+
+    logging.info('Spam filter triggered by %s (%s): %s', message.author.id, action, reason)
+    try:
+        if action == 'spam':
+            if not await ban_user(message.author, 'spam', f'Spam filter: {reason}'):
+                logging.info('DRY RUN: would have banned %s for spam.', message.author.id)
+                return
+            outcome = 'banned'
+        else:
+            length = SPAM_FILTER['rate_timeout']
+            record_timeout(message.author, length)
+            if DRY_RUN:
+                return logging.info('DRY RUN: would have timed out %s.', message.author.id)
+            await message.author.timeout(length, reason=f'Spam filter: {reason}')
+            outcome = f'timed out for {length}'
+    except discord.errors.Forbidden:
+        SPAM.flagged.pop(message.author.id, None)
+        return logging.error('Lacking permissions to act on %s for spam!', message.author.id)
+    except Exception as _e:
+        SPAM.flagged.pop(message.author.id, None)
+        return logging.error('EXCEPTION IN SPAM FILTER:\n%s', _e)
+
+    SPAM_LOG.append(
+        f'{message.author.mention} (`{message.author.id}`) {outcome} '
+        f'in {message.channel.mention}: {reason}')
+
 @client.event
 async def on_message_edit(before: discord.Message, after: discord.Message):
     """Log changes to cached messages."""
@@ -627,7 +1318,10 @@ async def on_member_update(before: Member, after: Member):
 
 @client.event
 async def on_member_ban(guild: Guild, user: User):
-    """Log members not banned through the bot."""
+    """Index banned users, and log members not banned through the bot."""
+    if guild.id == client.primary_guild.id:
+        BANS.add(user.id, user)
+
     entries = [entry async for entry in guild.audit_logs(limit=1, action=discord.AuditLogAction.ban)]
     if entries:
         entry = entries[0]
@@ -638,6 +1332,13 @@ async def on_member_ban(guild: Guild, user: User):
                 info=f"{entry.user.mention} possibly banned {user.mention} (`{user.id}`)",
                 color=COLORS['ban'])
 
+@client.event
+async def on_member_unban(guild: Guild, user: User):
+    """Drop unbanned users from the ban index and the spam filter's flagged users."""
+    if guild.id == client.primary_guild.id:
+        BANS.remove(user.id)
+        SPAM.flagged.pop(user.id, None)
+
 # Helper functions for multi-responsibility events
 async def handle_role_change(before: Member, after: Member):
     """Log changes to member roles."""
@@ -712,5 +1413,38 @@ async def handle_nickname_change(before: Member, after: Member):
     embed.set_footer(text=f"User ID: {after.id}")
     await client.logging_channels['member_nickname'].send(embed=embed)
 
-
-client.run(TOKEN)
+# Startup
+
+async def main():
+    """Run the bot, waiting for the leader lease first if failover is enabled."""
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    if not FAILOVER:
+        async with client:
+            return await client.start(TOKEN)
+
+    async with client:
+        if not FAKE_GATEWAY:
+            # Log in over HTTP while standing by, so a takeover only has to open the gateway
+            await client.login(TOKEN)
+        await wait_for_lease()
+        leader = asyncio.create_task(hold_lease())
+        try:
+            if FAKE_GATEWAY:
+                logging.info('Fake gateway: leading without connecting to Discord.')
+                await leader
+            else:
+                gateway = asyncio.create_task(client.connect())
+                await asyncio.wait((leader, gateway), return_when=asyncio.FIRST_COMPLETED)
+                if not leader.done():
+                    return gateway.result()
+        finally:
+            leader.cancel()
+            release_lease()
+    # Lease was lost, leave the restart to the container, which will come back as a standby
+    sys.exit(1)
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass